@@ -1,5 +1,7 @@
 ﻿import os
+import httpx
 from dotenv import load_dotenv
+from openai import OpenAI
 
 load_dotenv()
 
@@ -12,16 +14,33 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = "gpt-4-turbo"
 WHISPER_MODEL = "whisper-1"
 
+# Shared OpenAI client: one HTTP/2 connection pool for both Whisper and GPT requests
+OPENAI_HTTP_CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    timeout=httpx.Timeout(120.0)
+)
+OPENAI_CLIENT = OpenAI(api_key=OPENAI_API_KEY, http_client=OPENAI_HTTP_CLIENT, max_retries=2)
+
+# Redis (optional): share job state and progress updates across API workers
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_JOB_TTL_SECONDS = 7 * 24 * 3600
+
 # File paths
 UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "outputs"
 LOGS_DIR = "logs"
+WHISPER_CACHE_DIR = os.path.join(OUTPUT_DIR, ".whisper_cache")
+HIGHLIGHT_CACHE_DIR = os.path.join(OUTPUT_DIR, ".highlight_cache")
+JOBS_BY_HASH_PATH = os.path.join(OUTPUT_DIR, "jobs_by_hash.json")
 
 # Video processing
 TARGET_ASPECT_RATIO = 9/16
 TARGET_RESOLUTION = (1080, 1920)
 MIN_HIGHLIGHT_DURATION = 2
 MAX_VIDEO_SIZE_MB = 500
+# Re-encode the highlight reel for frame-accurate cuts instead of keyframe-aligned stream copy
+HIGHLIGHT_PRECISE_CUTS = False
 
 # Subtitle styling
 SUBTITLE_FONT_SIZE = 50
@@ -30,5 +49,5 @@ SUBTITLE_BG_COLOR = "black"
 SUBTITLE_BG_OPACITY = 0.7
 
 # Create directories
-for directory in [UPLOAD_DIR, OUTPUT_DIR, LOGS_DIR]:
+for directory in [UPLOAD_DIR, OUTPUT_DIR, LOGS_DIR, WHISPER_CACHE_DIR, HIGHLIGHT_CACHE_DIR]:
     os.makedirs(directory, exist_ok=True)
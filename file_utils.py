@@ -0,0 +1,9 @@
+﻿import os
+import json
+
+def write_json_atomic(path: str, payload) -> None:
+    """Write a JSON payload via a temp file so readers never see a partial file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
@@ -1,21 +1,20 @@
-﻿from openai import OpenAI
+﻿import os
+import hashlib
+from functools import lru_cache
 import json
 import logging
 
+from file_utils import write_json_atomic
+
 logger = logging.getLogger(__name__)
 
-class HighlightDetector:
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
-    
-    def detect_highlights(self, subtitles: list, min_duration: int = 2) -> list:
-        try:
-            subtitle_text = "\n".join([
-                f"[{s['start']:.1f}s - {s['end']:.1f}s]: {s['text']}"
-                for s in subtitles
-            ])
-            
-            prompt = f"""Analyze the following video subtitles and identify the most engaging and important highlight segments. For each highlight, provide:
+# Bump when SYSTEM_PROMPT or the request changes so cached results are invalidated
+PROMPT_VERSION = 2
+
+# Static instructions kept as a fixed prefix so repeated requests share it
+SYSTEM_PROMPT = """You are a video editor expert at finding engaging highlights.
+
+Analyze the video subtitles you are given and identify the most engaging and important highlight segments. For each highlight, provide:
 1. Start time (in seconds)
 2. End time (in seconds)
 3. Why it's a good highlight
@@ -28,35 +27,86 @@ Focus on:
 - Entertaining exchanges
 - Key takeaways
 
-Format your response as a JSON array with objects containing: start, end, reason, score
+Respond with a JSON object of the form {"highlights": [...]} where each item contains: start, end, reason, score"""
 
-Subtitles:
-{subtitle_text}
-
-Minimum highlight duration: {min_duration} seconds
-
-JSON Response:"""
-
-            response = self.client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a video editor expert at finding engaging highlights."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            
-            content = response.choices[0].message.content
-            json_start = content.find('[')
-            json_end = content.rfind(']') + 1
-            json_str = content[json_start:json_end]
-            
-            highlights = json.loads(json_str)
+class HighlightDetector:
+    def __init__(self, client, cache_dir: str = os.path.join("outputs", ".highlight_cache"), model: str = "gpt-4-turbo"):
+        self.client = client
+        self.model = model
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+    
+    def detect_highlights(self, subtitles: list, min_duration: int = 2) -> list:
+        try:
+            # Stable serialization so identical subtitle sets share a cache entry
+            subtitle_json = json.dumps(subtitles, sort_keys=True)
+            highlights = self._detect_cached(subtitle_json, min_duration)
             logger.info(f"Detected {len(highlights)} highlights")
             
-            return highlights
+            # Callers get their own copies of the memoized result
+            return [dict(h) for h in highlights]
         
         except Exception as e:
             logger.error(f"Error detecting highlights: {str(e)}")
             raise
+    
+    @lru_cache(maxsize=128)
+    def _detect_cached(self, subtitle_json: str, min_duration: int) -> tuple:
+        """Detect highlights, memoized in process and persisted on disk"""
+        # Cache key: model + prompt version + minimum duration + transcript
+        key = f"{self.model}:{PROMPT_VERSION}:{min_duration}:{subtitle_json}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        cache_path = os.path.join(self.cache_dir, f"{digest}.json")
+        
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            # Entries written before validation existed may be malformed; re-detect those
+            if isinstance(cached, list) and all(self._is_valid_highlight(h) for h in cached):
+                logger.info(f"Using cached highlights {cache_path}")
+                return tuple(cached)
+            logger.warning(f"Ignoring malformed cached highlights {cache_path}")
+        
+        subtitles = json.loads(subtitle_json)
+        subtitle_text = "\n".join([
+            f"[{s['start']:.1f}s - {s['end']:.1f}s]: {s['text']}"
+            for s in subtitles
+        ])
+        
+        prompt = f"""Subtitles:
+{subtitle_text}
+
+Minimum highlight duration: {min_duration} seconds"""
+
+        response = self.client.chat.completions.create(
+            model=self.model,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.7,
+            max_tokens=1500
+        )
+        
+        data = json.loads(response.choices[0].message.content)
+        highlights = data.get("highlights") if isinstance(data, dict) else None
+        
+        # Don't cache a malformed response, or the transcript would never be retried
+        if not isinstance(highlights, list) or not all(self._is_valid_highlight(h) for h in highlights):
+            raise ValueError(f"Unexpected highlights response: {str(data)[:200]}")
+        
+        write_json_atomic(cache_path, highlights)
+        return tuple(highlights)
+    
+    @staticmethod
+    def _is_valid_highlight(highlight) -> bool:
+        """Check a highlight has numeric start/end seconds with end after start"""
+        if not isinstance(highlight, dict):
+            return False
+        start, end = highlight.get("start"), highlight.get("end")
+        for value in (start, end):
+            # bool is an int subclass but never a valid timestamp
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return False
+        return end > start
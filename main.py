@@ -4,24 +4,42 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import os
 import uuid
+import hashlib
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
 import json
 import asyncio
 import subprocess
+import aiofiles
+import redis.asyncio as aioredis
 
 import config
+from file_utils import write_json_atomic
 from video_processor import VideoProcessor
 from subtitle_extractor import SubtitleExtractor
-from highlight_detector import HighlightDetector
+from highlight_detector import HighlightDetector, PROMPT_VERSION
+
+# Log records go through a queue; the real handlers write on a background thread
+log_queue = queue.Queue(-1)
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler(os.path.join(config.LOGS_DIR, 'app.log')),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(config.LOGS_DIR, 'app.log')),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
@@ -39,38 +57,147 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-video_processor = VideoProcessor(target_resolution=config.TARGET_RESOLUTION)
-subtitle_extractor = SubtitleExtractor(api_key=config.OPENAI_API_KEY)
-highlight_detector = HighlightDetector(api_key=config.OPENAI_API_KEY)
+video_processor = VideoProcessor(
+    target_resolution=config.TARGET_RESOLUTION,
+    precise_cuts=config.HIGHLIGHT_PRECISE_CUTS
+)
+subtitle_extractor = SubtitleExtractor(client=config.OPENAI_CLIENT, cache_dir=config.WHISPER_CACHE_DIR)
+highlight_detector = HighlightDetector(
+    client=config.OPENAI_CLIENT,
+    cache_dir=config.HIGHLIGHT_CACHE_DIR,
+    model=config.OPENAI_MODEL
+)
 
 jobs = {}
+job_events = {}
+
+# Optional shared job store so several API workers see the same state
+redis_client = aioredis.from_url(config.REDIS_URL, decode_responses=True) if config.REDIS_URL else None
+
+TERMINAL_STATUSES = ("completed", "error")
+
+# Upload content hash -> completed job_id, persisted so repeat uploads skip the pipeline
+completed_by_hash = {}
+if os.path.exists(config.JOBS_BY_HASH_PATH):
+    with open(config.JOBS_BY_HASH_PATH, "r") as f:
+        completed_by_hash = json.load(f)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+FILE_MAPPING = MappingProxyType({
+    "final": "final_with_subtitles.mp4",
+    "highlights": "highlights.mp4",
+    "subtitles": "subtitles.srt",
+    "metadata": "metadata.json"
+})
+
+MEDIA_TYPES = MappingProxyType({
+    "final": "video/mp4",
+    "highlights": "video/mp4",
+    "subtitles": "text/plain",
+    "metadata": "application/json"
+})
+
+@lru_cache(maxsize=4096)
+def _resolved_path(job_id: str, file_type: str) -> str:
+    return os.path.join(config.OUTPUT_DIR, job_id, FILE_MAPPING[file_type])
 
 class VideoURL(BaseModel):
     url: str
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections = {}
+def notify_job(job_id: str):
+    """Wake every websocket waiting on this job's next state change"""
+    event = job_events.pop(job_id, None)
+    if event:
+        event.set()
+
+async def publish_job(job_id: str):
+    """Persist job state to Redis (if configured) and notify listeners"""
+    if redis_client:
+        state = jobs[job_id]
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(f"job:{job_id}", mapping={k: json.dumps(v) for k, v in state.items()})
+            # Job hashes carry the full subtitle list, so don't keep them forever
+            pipe.expire(f"job:{job_id}", config.REDIS_JOB_TTL_SECONDS)
+            await pipe.execute()
+        await redis_client.publish(f"job:{job_id}", json.dumps(state))
+    notify_job(job_id)
+
+def job_dedup_key(upload_hash: str) -> str:
+    """Key a completed job on the upload content plus every setting that shapes its outputs"""
+    settings = json.dumps([
+        config.OPENAI_MODEL,
+        PROMPT_VERSION,
+        list(config.TARGET_RESOLUTION),
+        config.HIGHLIGHT_PRECISE_CUTS
+    ])
+    return hashlib.sha256(f"{upload_hash}:{settings}".encode("utf-8")).hexdigest()
+
+def completed_job_outputs(job_id: str):
+    """Get a job's metadata if all of its output files are still on disk"""
+    metadata_path = _resolved_path(job_id, "metadata")
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, "r") as f:
+        metadata = json.load(f)
+    
+    required = ["final", "subtitles"]
+    # The highlight reel is skipped when no clamped highlight was long enough to cut
+    if metadata.get("has_highlight_reel", True):
+        required.append("highlights")
+    if not all(os.path.exists(_resolved_path(job_id, file_type)) for file_type in required):
+        return None
+    return metadata
+
+async def find_completed_job(content_hash: str):
+    """Get the job_id of a completed job for the same upload content, if any"""
+    if redis_client:
+        job_id = await redis_client.hget("jobs_by_hash", content_hash)
+    else:
+        job_id = completed_by_hash.get(content_hash)
+    if not job_id:
+        return None
     
-    async def connect(self, websocket: WebSocket, job_id: str):
-        await websocket.accept()
-        if job_id not in self.active_connections:
-            self.active_connections[job_id] = []
-        self.active_connections[job_id].append(websocket)
+    # Outputs may have been cleaned up since; only reuse the job if they're all there
+    metadata = completed_job_outputs(job_id)
+    if metadata is None:
+        return None
     
-    async def disconnect(self, job_id: str, websocket: WebSocket):
-        if job_id in self.active_connections:
-            self.active_connections[job_id].remove(websocket)
+    state = await load_job(job_id)
+    if state is None:
+        # Not known to this process (e.g. after a restart): restore from its metadata
+        state = jobs[job_id] = {
+            "status": "completed",
+            "progress": 100,
+            "message": "Processing completed successfully!",
+            "output_dir": os.path.join(config.OUTPUT_DIR, job_id),
+            "metadata": metadata
+        }
+        # Write it back to Redis (fresh TTL) so every API worker can serve this job_id
+        await publish_job(job_id)
+    elif redis_client:
+        # The job is about to be handed out again, so keep its Redis state alive
+        await redis_client.expire(f"job:{job_id}", config.REDIS_JOB_TTL_SECONDS)
     
-    async def broadcast(self, job_id: str, message: dict):
-        if job_id in self.active_connections:
-            for connection in self.active_connections[job_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
+    return job_id if state["status"] == "completed" else None
+
+async def record_completed_job(content_hash: str, job_id: str):
+    """Remember which job processed this upload content"""
+    if redis_client:
+        await redis_client.hset("jobs_by_hash", content_hash, job_id)
+        return
+    completed_by_hash[content_hash] = job_id
+    write_json_atomic(config.JOBS_BY_HASH_PATH, completed_by_hash)
 
-manager = ConnectionManager()
+async def load_job(job_id: str):
+    """Get job state from this process, falling back to Redis"""
+    if job_id in jobs:
+        return jobs[job_id]
+    if redis_client:
+        state = await redis_client.hgetall(f"job:{job_id}")
+        if state:
+            return {k: json.loads(v) for k, v in state.items()}
+    return None
 
 def download_video_from_url(url: str, output_path: str) -> str:
     """Download video from URL using yt-dlp"""
@@ -106,27 +233,53 @@ async def process_video(file: UploadFile = File(...), background_tasks: Backgrou
             raise HTTPException(status_code=400, detail="Invalid video format")
         
         upload_path = os.path.join(config.UPLOAD_DIR, f"{job_id}_{file.filename}")
-        with open(upload_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
         
-        file_size_mb = len(content) / (1024 * 1024)
-        if file_size_mb > config.MAX_VIDEO_SIZE_MB:
+        # Stream to disk in chunks so memory stays bounded and oversized uploads fail fast
+        size = 0
+        limit = config.MAX_VIDEO_SIZE_MB * 1024 * 1024
+        too_large = False
+        content_hash = hashlib.sha256()
+        async with aiofiles.open(upload_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > limit:
+                    too_large = True
+                    break
+                content_hash.update(chunk)
+                await f.write(chunk)
+        
+        if too_large:
+            os.remove(upload_path)
             raise HTTPException(status_code=413, detail=f"File too large (max {config.MAX_VIDEO_SIZE_MB}MB)")
         
+        # Identical content was already processed: reuse that job's outputs
+        digest = job_dedup_key(content_hash.hexdigest())
+        prior_job_id = await find_completed_job(digest)
+        if prior_job_id:
+            os.remove(upload_path)
+            logger.info(f"Upload matches completed job {prior_job_id}, skipping processing")
+            return {
+                "job_id": prior_job_id,
+                "status": "completed",
+                "message": "Video already processed",
+                "cached": True
+            }
+        
         jobs[job_id] = {
             "status": "processing",
             "progress": 0,
             "message": "Uploaded successfully, starting processing...",
             "created_at": datetime.now().isoformat()
         }
+        await publish_job(job_id)
         
         if background_tasks:
             background_tasks.add_task(
                 process_video_async,
                 job_id,
                 upload_path,
-                file.filename
+                file.filename,
+                content_hash=digest
             )
         
         return {
@@ -135,6 +288,8 @@ async def process_video(file: UploadFile = File(...), background_tasks: Backgrou
             "message": "Video processing started"
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in process_video: {str(e)}")
         jobs[job_id] = {"status": "error", "message": str(e)}
@@ -157,6 +312,7 @@ async def process_video_url(video_url: VideoURL, background_tasks: BackgroundTas
             "message": "Downloading video from URL...",
             "created_at": datetime.now().isoformat()
         }
+        await publish_job(job_id)
         
         if background_tasks:
             background_tasks.add_task(
@@ -195,42 +351,54 @@ async def process_url_async(job_id: str, url: str):
         logger.error(f"Error processing URL {job_id}: {str(e)}")
         jobs[job_id]["status"] = "error"
         jobs[job_id]["message"] = str(e)
-        await manager.broadcast(job_id, jobs[job_id])
+        await publish_job(job_id)
 
-async def process_video_async(job_id: str, video_path: str, filename: str, start_progress: int = 0):
+async def process_video_async(job_id: str, video_path: str, filename: str, start_progress: int = 0, content_hash: str = None):
     try:
         job_output_dir = os.path.join(config.OUTPUT_DIR, job_id)
         os.makedirs(job_output_dir, exist_ok=True)
         
-        await update_job(job_id, "processing", start_progress + 20, "Extracting audio...")
-        audio_path = os.path.join(job_output_dir, "audio.mp3")
-        video_processor.extract_audio(video_path, audio_path)
-        
-        await update_job(job_id, "processing", start_progress + 35, "Extracting subtitles using Whisper...")
-        subtitles = subtitle_extractor.extract_subtitles(audio_path)
+        resized_path = os.path.join(job_output_dir, "resized.mp4")
         
-        await update_job(job_id, "processing", start_progress + 50, "Detecting highlights with GPT-4...")
-        highlights = highlight_detector.detect_highlights(
-            subtitles,
-            min_duration=config.MIN_HIGHLIGHT_DURATION
-        )
+        async def subtitles_pipeline():
+            # Audio is encoded in memory and sent straight to Whisper
+            await update_job(job_id, "processing", start_progress + 20, "Extracting audio and subtitles using Whisper...")
+            subtitles = await asyncio.to_thread(subtitle_extractor.extract_subtitles, video_path=video_path)
+            
+            await update_job(job_id, "processing", start_progress + 50, "Detecting highlights with GPT-4...")
+            highlights = await asyncio.to_thread(
+                highlight_detector.detect_highlights,
+                subtitles,
+                min_duration=config.MIN_HIGHLIGHT_DURATION
+            )
+            return subtitles, highlights
         
-        await update_job(job_id, "processing", start_progress + 60, "Resizing video to 9:16 vertical format...")
-        resized_path = os.path.join(job_output_dir, "resized.mp4")
-        video_processor.resize_video(video_path, resized_path)
+        # Resizing (ffmpeg) is independent of the Whisper/GPT-4 chain, so overlap them
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(asyncio.to_thread(video_processor.resize_video, video_path, resized_path))
+            subtitles_task = tg.create_task(subtitles_pipeline())
+        subtitles, highlights = subtitles_task.result()
         
-        await update_job(job_id, "processing", start_progress + 70, "Embedding subtitles into video...")
+        await update_job(job_id, "processing", start_progress + 70, "Embedding subtitles and creating highlight reel...")
         srt_path = os.path.join(job_output_dir, "subtitles.srt")
         srt_content = subtitle_extractor.generate_srt(subtitles)
         with open(srt_path, "w") as f:
             f.write(srt_content)
         
-        final_path = os.path.join(job_output_dir, f"final_with_subtitles.mp4")
-        video_processor.add_subtitles(resized_path, srt_path, final_path)
+        # Styled ASS is what gets burned in; the SRT stays available for download
+        ass_path = os.path.join(job_output_dir, "subtitles.ass")
+        with open(ass_path, "w", encoding="utf-8") as f:
+            f.write(subtitle_extractor.generate_ass(subtitles))
         
-        await update_job(job_id, "processing", start_progress + 80, "Creating highlight reel...")
+        final_path = os.path.join(job_output_dir, f"final_with_subtitles.mp4")
         highlight_path = os.path.join(job_output_dir, "highlights.mp4")
-        video_processor.create_highlight_video(resized_path, highlights, highlight_path)
+        
+        # Both outputs only read the resized video, so encode them concurrently
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(asyncio.to_thread(video_processor.add_subtitles, resized_path, ass_path, final_path))
+            highlight_task = tg.create_task(
+                asyncio.to_thread(video_processor.create_highlight_video, resized_path, highlights, highlight_path)
+            )
         
         await update_job(job_id, "processing", 95, "Finalizing results...")
         
@@ -241,6 +409,7 @@ async def process_video_async(job_id: str, video_path: str, filename: str, start
             "subtitles": subtitles,
             "num_highlights": len(highlights),
             "num_subtitles": len(subtitles),
+            "has_highlight_reel": highlight_task.result() is not None,
             "processed_at": datetime.now().isoformat()
         }
         
@@ -253,76 +422,107 @@ async def process_video_async(job_id: str, video_path: str, filename: str, start
         jobs[job_id]["output_dir"] = job_output_dir
         jobs[job_id]["metadata"] = metadata
         
-        await manager.broadcast(job_id, jobs[job_id])
+        await publish_job(job_id)
+        if content_hash:
+            await record_completed_job(content_hash, job_id)
         logger.info(f"Job {job_id} completed successfully")
     
     except Exception as e:
+        # Surface the original stage error rather than the TaskGroup wrapper
+        while isinstance(e, ExceptionGroup):
+            e = e.exceptions[0]
         logger.error(f"Error processing video {job_id}: {str(e)}")
         jobs[job_id]["status"] = "error"
         jobs[job_id]["message"] = str(e)
-        await manager.broadcast(job_id, jobs[job_id])
+        await publish_job(job_id)
 
 async def update_job(job_id: str, status: str, progress: int, message: str):
     jobs[job_id]["status"] = status
     jobs[job_id]["progress"] = min(progress, 100)
     jobs[job_id]["message"] = message
-    await manager.broadcast(job_id, jobs[job_id])
+    await publish_job(job_id)
 
 @app.get("/api/job/{job_id}")
 async def get_job_status(job_id: str):
-    if job_id not in jobs:
+    state = await load_job(job_id)
+    if state is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return jobs[job_id]
+    return state
+
+async def stream_job_events(websocket: WebSocket, job_id: str):
+    """Send job state on every local update until the job finishes"""
+    while True:
+        event = job_events.setdefault(job_id, asyncio.Event())
+        await websocket.send_json(jobs[job_id])
+        if jobs[job_id]["status"] in TERMINAL_STATUSES:
+            # No further notify_job will come to pop this event
+            job_events.pop(job_id, None)
+            return
+        await event.wait()
+
+async def stream_job_pubsub(websocket: WebSocket, job_id: str):
+    """Forward job state published by any worker until the job finishes"""
+    pubsub = redis_client.pubsub()
+    # Subscribe before reading the current state so no update is missed
+    await pubsub.subscribe(f"job:{job_id}")
+    try:
+        state = await load_job(job_id)
+        await websocket.send_json(state)
+        if state["status"] in TERMINAL_STATUSES:
+            return
+        
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            await websocket.send_text(message["data"])
+            if json.loads(message["data"])["status"] in TERMINAL_STATUSES:
+                return
+    finally:
+        await pubsub.unsubscribe(f"job:{job_id}")
+        await pubsub.aclose()
 
 @app.websocket("/ws/job/{job_id}")
 async def websocket_endpoint(websocket: WebSocket, job_id: str):
-    await manager.connect(websocket, job_id)
+    await websocket.accept()
     
     try:
-        while True:
-            if job_id in jobs:
-                await websocket.send_json(jobs[job_id])
-            
-            await asyncio.sleep(0.5)
+        if await load_job(job_id) is None:
+            await websocket.close(code=1008)
+            return
+        
+        # Send the current state, then only push again when the job changes
+        if redis_client:
+            await stream_job_pubsub(websocket, job_id)
+        else:
+            await stream_job_events(websocket, job_id)
+        
+        await websocket.close()
     except WebSocketDisconnect:
-        await manager.disconnect(job_id, websocket)
+        pass
     except Exception as e:
         logger.error(f"WebSocket error: {str(e)}")
-        await manager.disconnect(job_id, websocket)
 
 @app.get("/api/download/{job_id}/{file_type}")
 async def download_file(job_id: str, file_type: str):
-    if job_id not in jobs:
+    if await load_job(job_id) is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job_output_dir = os.path.join(config.OUTPUT_DIR, job_id)
-    
-    file_mapping = {
-        "final": "final_with_subtitles.mp4",
-        "highlights": "highlights.mp4",
-        "subtitles": "subtitles.srt",
-        "metadata": "metadata.json"
-    }
-    
-    media_types = {
-        "final": "video/mp4",
-        "highlights": "video/mp4",
-        "subtitles": "text/plain",
-        "metadata": "application/json"
-    }
-    
-    if file_type not in file_mapping:
+    if file_type not in FILE_MAPPING:
         raise HTTPException(status_code=400, detail="Invalid file type")
     
-    file_path = os.path.join(job_output_dir, file_mapping[file_type])
+    file_path = _resolved_path(job_id, file_type)
     
-    if not os.path.exists(file_path):
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     
+    # Pass the stat along so Starlette doesn't stat the file again
     return FileResponse(
         file_path, 
-        media_type=media_types[file_type],
-        filename=file_mapping[file_type]
+        media_type=MEDIA_TYPES[file_type],
+        filename=FILE_MAPPING[file_type],
+        stat_result=stat_result
     )
 
 @app.get("/")
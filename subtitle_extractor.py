@@ -1,42 +1,77 @@
 ﻿import os
-from datetime import timedelta
-from openai import OpenAI
+import io
+import hashlib
+import csv
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import json
 import logging
 
+from file_utils import write_json_atomic
+
 logger = logging.getLogger(__name__)
 
+# ASS header matching ffmpeg's SRT conversion with the burned-in force_style
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 384
+PlayResY: 288
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,40,&H00FFFFFF,&H00FFFFFF,&H000000FF,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,10,10,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+# Long audio is split into chunks of this length and transcribed concurrently
+WHISPER_CHUNK_SECONDS = 600
+WHISPER_MAX_WORKERS = 4
+
 class SubtitleExtractor:
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, client, cache_dir: str = os.path.join("outputs", ".whisper_cache")):
+        self.client = client
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
     
-    def extract_subtitles(self, audio_path: str, language: str = None) -> list:
-        """Extract subtitles from audio using Whisper API"""
+    def extract_subtitles(self, audio_path: str = None, language: str = None, video_path: str = None) -> list:
+        """Extract subtitles from audio (or a video's audio track) using Whisper API"""
         try:
-            logger.info(f"Extracting subtitles from {audio_path}")
+            logger.info(f"Extracting subtitles from {video_path or audio_path}")
             
-            with open(audio_path, "rb") as audio_file:
-                # Build request parameters
-                params = {
-                    "model": "whisper-1",
-                    "file": audio_file,
-                    "response_format": "verbose_json"
-                }
-                
-                # Add language if specified (not auto)
-                if language and language != "auto":
-                    params["language"] = language
-                
-                transcript = self.client.audio.transcriptions.create(**params)
+            if video_path:
+                data = self.encode_audio(video_path)
+                name = "audio.ogg"
+            else:
+                with open(audio_path, "rb") as audio_file:
+                    data = audio_file.read()
+                name = os.path.basename(audio_path)
+            
+            # Cache key: audio content hash + requested language
+            digest = hashlib.sha256(data).hexdigest()
+            cache_path = os.path.join(self.cache_dir, f"{digest}_{language or 'auto'}.json")
+            
+            if os.path.exists(cache_path):
+                logger.info(f"Using cached transcription {cache_path}")
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    transcript = json.load(f)
+            else:
+                transcript = {"segments": self._transcribe_chunked(data, name, language)}
+                write_json_atomic(cache_path, transcript)
             
             subtitles = []
-            for segment in transcript.segments:
+            for segment in transcript.get("segments") or []:
                 subtitle = {
-                    "id": segment.id,
-                    "start": segment.start,
-                    "end": segment.end,
-                    "text": segment.text.strip(),
-                    "confidence": getattr(segment, 'confidence', 0)
+                    "id": segment["id"],
+                    "start": segment["start"],
+                    "end": segment["end"],
+                    "text": segment["text"].strip(),
+                    "confidence": segment.get("confidence", 0)
                 }
                 subtitles.append(subtitle)
             
@@ -47,55 +82,204 @@ class SubtitleExtractor:
             logger.error(f"Error extracting subtitles: {str(e)}")
             raise
     
+    @staticmethod
+    def encode_audio(video_path: str) -> bytes:
+        """Encode a video's audio track to 16 kHz mono Opus in memory"""
+        cmd = [
+            "ffmpeg", "-i", video_path,
+            "-vn", "-ac", "1", "-ar", "16000",
+            "-c:a", "libopus", "-b:a", "24k",
+            # Bit-exact output keeps the bytes (and so the cache key) stable
+            "-fflags", "+bitexact", "-flags:a", "+bitexact",
+            "-f", "ogg", "pipe:1"
+        ]
+        result = subprocess.run(cmd, check=True, capture_output=True)
+        return result.stdout
+    
+    @staticmethod
+    def _audio_duration(data: bytes):
+        """Get audio duration in seconds, or None if it can't be determined"""
+        # Ogg Opus: the last page's granule position (48 kHz samples) minus pre-skip
+        head = data.find(b"OpusHead")
+        if data.startswith(b"OggS") and head != -1:
+            pre_skip = int.from_bytes(data[head + 10:head + 12], "little")
+            last_page = data.rfind(b"OggS")
+            granule = int.from_bytes(data[last_page + 6:last_page + 14], "little", signed=True)
+            if granule >= 0:
+                return max(0, granule - pre_skip) / 48000
+        
+        cmd = [
+            "ffprobe", "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            "-i", "pipe:0"
+        ]
+        try:
+            result = subprocess.run(cmd, input=data, check=True, capture_output=True)
+            return float(result.stdout.strip())
+        except (subprocess.CalledProcessError, ValueError):
+            return None
+    
+    def _transcribe_chunked(self, data: bytes, name: str, language: str = None) -> list:
+        """Transcribe audio in concurrent chunks and merge segments in order"""
+        # Short audio: send the bytes we already have in memory, no split needed
+        duration = self._audio_duration(data)
+        if duration is not None and duration <= WHISPER_CHUNK_SECONDS:
+            return self._transcribe_one(data, name, 0, language)
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            chunks = self._split_audio(data, name, temp_dir)
+            
+            if len(chunks) <= 1:
+                return self._transcribe_one(data, name, 0, language)
+            
+            logger.info(f"Transcribing {len(chunks)} audio chunks concurrently")
+            with ThreadPoolExecutor(max_workers=WHISPER_MAX_WORKERS) as executor:
+                futures = []
+                for chunk_path, offset in chunks:
+                    with open(chunk_path, "rb") as f:
+                        chunk_data = f.read()
+                    futures.append(executor.submit(
+                        self._transcribe_one, chunk_data, os.path.basename(chunk_path), offset, language
+                    ))
+                
+                segments = []
+                for future in futures:
+                    segments.extend(future.result())
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        segments.sort(key=lambda s: s["start"])
+        for idx, segment in enumerate(segments):
+            segment["id"] = idx
+        return segments
+    
+    @staticmethod
+    def _split_audio(data: bytes, name: str, output_dir: str) -> list:
+        """Split audio into fixed-length chunks, returning (path, start offset) pairs"""
+        ext = os.path.splitext(name)[1] or ".mp3"
+        list_path = os.path.join(output_dir, "chunks.csv")
+        cmd = [
+            "ffmpeg", "-i", "pipe:0",
+            "-f", "segment",
+            "-segment_time", str(WHISPER_CHUNK_SECONDS),
+            "-segment_list", list_path,
+            "-segment_list_type", "csv",
+            "-reset_timestamps", "1",
+            "-c", "copy",
+            "-y", os.path.join(output_dir, f"chunk_%03d{ext}")
+        ]
+        subprocess.run(cmd, input=data, check=True, capture_output=True)
+        
+        # The segment list records each chunk's actual start time
+        with open(list_path, newline="") as f:
+            return [
+                (os.path.join(output_dir, row[0]), float(row[1]))
+                for row in csv.reader(f) if row
+            ]
+    
+    def _transcribe_one(self, data: bytes, name: str, offset: float, language: str = None) -> list:
+        """Transcribe a single audio chunk, shifting segment times by offset"""
+        audio_file = io.BytesIO(data)
+        audio_file.name = name
+        
+        # Build request parameters; segment timestamps only, no word-level payload
+        params = {
+            "model": "whisper-1",
+            "file": audio_file,
+            "response_format": "verbose_json",
+            "extra_body": {"timestamp_granularities": ["segment"]}
+        }
+        
+        # Add language if specified (not auto)
+        if language and language != "auto":
+            params["language"] = language
+        
+        transcript = self.client.audio.transcriptions.create(**params).model_dump()
+        
+        # Keep only the fields extract_subtitles uses
+        return [
+            {
+                "id": segment["id"],
+                "start": segment["start"] + offset,
+                "end": segment["end"] + offset,
+                "text": segment["text"]
+            }
+            for segment in transcript.get("segments") or []
+        ]
+    
     def filter_subtitles_for_highlights(self, subtitles: list, highlights: list) -> list:
         """Filter subtitles to only include those within highlight segments"""
         filtered = []
-        subtitle_id = 0
+        if not subtitles:
+            return filtered
+        
+        starts = np.fromiter((s['start'] for s in subtitles), dtype=np.float64, count=len(subtitles))
+        ends = np.fromiter((s['end'] for s in subtitles), dtype=np.float64, count=len(subtitles))
+        
+        # Offset of the current highlight within the highlight reel
+        offset = 0.0
         
         for highlight in highlights:
             h_start = highlight['start']
             h_end = highlight['end']
             
-            # Calculate offset for this highlight segment
-            if filtered:
-                # Get the end time of the last subtitle
-                offset = filtered[-1]['end']
-            else:
-                offset = 0
+            # Subtitles overlapping the highlight, with timing relative to the reel
+            idx = np.flatnonzero((ends > h_start) & (starts < h_end))
+            if not len(idx):
+                continue
+            new_starts = np.maximum(starts[idx] - h_start, 0) + offset
+            new_ends = np.minimum(ends[idx] - h_start, h_end - h_start) + offset
+            
+            for i, new_start, new_end in zip(idx.tolist(), new_starts.tolist(), new_ends.tolist()):
+                sub = subtitles[i]
+                filtered.append({
+                    "id": len(filtered),
+                    "start": new_start,
+                    "end": new_end,
+                    "text": sub['text'],
+                    "confidence": sub.get('confidence', 0)
+                })
             
-            for sub in subtitles:
-                # Check if subtitle overlaps with highlight
-                if sub['end'] > h_start and sub['start'] < h_end:
-                    # Adjust timing relative to highlight reel
-                    new_start = max(0, sub['start'] - h_start) + offset
-                    new_end = min(sub['end'] - h_start, h_end - h_start) + offset
-                    
-                    filtered.append({
-                        "id": subtitle_id,
-                        "start": new_start,
-                        "end": new_end,
-                        "text": sub['text'],
-                        "confidence": sub.get('confidence', 0)
-                    })
-                    subtitle_id += 1
+            offset = filtered[-1]['end']
         
         return filtered
     
     @staticmethod
     def format_time(seconds: float) -> str:
         """Convert seconds to SRT format (HH:MM:SS,mmm)"""
-        td = timedelta(seconds=seconds)
-        hours = td.seconds // 3600
-        minutes = (td.seconds % 3600) // 60
-        secs = td.seconds % 60
-        milliseconds = td.microseconds // 1000
+        # Round to microseconds first (as timedelta did), then truncate to ms
+        total_ms = round(seconds * 1_000_000) // 1000
+        hours, rem = divmod(total_ms, 3_600_000)
+        minutes, rem = divmod(rem, 60_000)
+        secs, milliseconds = divmod(rem, 1000)
         return f"{hours:02d}:{minutes:02d}:{secs:02d},{milliseconds:03d}"
     
     def generate_srt(self, subtitles: list) -> str:
         """Convert subtitle list to SRT format"""
-        srt_content = ""
-        for idx, sub in enumerate(subtitles, 1):
-            srt_content += f"{idx}\n"
-            srt_content += f"{self.format_time(sub['start'])} --> {self.format_time(sub['end'])}\n"
-            srt_content += f"{sub['text']}\n\n"
-        return srt_content
\ No newline at end of file
+        format_time = self.format_time
+        return "".join([
+            f"{idx}\n{format_time(sub['start'])} --> {format_time(sub['end'])}\n{sub['text']}\n\n"
+            for idx, sub in enumerate(subtitles, 1)
+        ])
+    
+    @staticmethod
+    def format_ass_time(seconds: float) -> str:
+        """Convert seconds to ASS format (H:MM:SS.cc)"""
+        total_cs = round(seconds * 100)
+        hours, rem = divmod(total_cs, 360_000)
+        minutes, rem = divmod(rem, 6000)
+        secs, centiseconds = divmod(rem, 100)
+        return f"{hours:d}:{minutes:02d}:{secs:02d}.{centiseconds:02d}"
+    
+    def generate_ass(self, subtitles: list) -> str:
+        """Convert subtitle list to styled ASS format for burning in"""
+        format_time = self.format_ass_time
+        parts = [ASS_HEADER]
+        for sub in subtitles:
+            text = sub['text'].replace("\n", "\\N")
+            parts.append(
+                f"Dialogue: 0,{format_time(sub['start'])},{format_time(sub['end'])},Default,,0,0,0,,{text}\n"
+            )
+        return "".join(parts)
\ No newline at end of file
@@ -1,59 +1,93 @@
 ﻿import logging
 import subprocess
 import os
-from moviepy.editor import VideoFileClip, concatenate_videoclips
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# Preferred H.264 encoders, hardware first, with their quality settings
+H264_ENCODERS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "23"],
+    "h264_videotoolbox": ["-c:v", "h264_videotoolbox", "-b:v", "8M"],
+    "libx264": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-threads", "0"],
+}
+
+# ffmpeg stderr markers for an encoder that failed to initialize (e.g. no GPU session)
+ENCODER_OPEN_ERRORS = (b"Error while opening encoder", b"Could not open encoder")
+
+def escape_filter_path(path: str) -> str:
+    """Escape a file path for use as an unquoted ffmpeg filter option value"""
+    # Forward slashes for Windows paths
+    path = path.replace("\\", "/")
+    # Filter option level: value is split on ':' and unquoted/unescaped
+    value = re.sub(r"([\\':])", r"\\\1", path)
+    # Filtergraph level: the whole -vf string is tokenized on [],; before that
+    return re.sub(r"([\\'\[\],;])", r"\\\1", value)
+
 class VideoProcessor:
-    def __init__(self, target_resolution=(1080, 1920)):
+    def __init__(self, target_resolution=(1080, 1920), precise_cuts: bool = False):
         self.target_resolution = target_resolution
+        self.precise_cuts = precise_cuts
+        self.video_encoder = self._detect_encoder()
     
-    def extract_audio(self, video_path: str, output_audio_path: str) -> str:
-        """Extract audio from video using ffmpeg"""
-        try:
-            logger.info(f"Extracting audio from {video_path}")
+    @staticmethod
+    def _detect_encoder() -> str:
+        """Pick the best H.264 encoder that ffmpeg can actually open"""
+        for encoder in H264_ENCODERS:
+            if encoder == "libx264":
+                break
+            # Hardware encoders can be compiled in without a usable device, so try a tiny encode
             cmd = [
-                "ffmpeg", "-i", video_path,
-                "-q:a", "0", "-map", "a",
-                "-y", output_audio_path
+                "ffmpeg", "-hide_banner",
+                "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+                "-frames:v", "1", "-pix_fmt", "yuv420p",
+                *H264_ENCODERS[encoder],
+                "-f", "null", "-"
             ]
+            try:
+                subprocess.run(cmd, check=True, capture_output=True)
+                logger.info(f"Using video encoder {encoder}")
+                return encoder
+            except Exception:
+                continue
+        logger.info("Using video encoder libx264")
+        return "libx264"
+    
+    def _run_encode(self, cmd_prefix: list, output_path: str):
+        """Run an ffmpeg encode, retrying with libx264 only if the hw encoder fails to open"""
+        encoder = self.video_encoder
+        # yuv420p keeps 10-bit / 4:2:2 / 4:4:4 sources browser-playable and NVENC-compatible
+        encode_args = ["-pix_fmt", "yuv420p"]
+        cmd = cmd_prefix + encode_args + H264_ENCODERS[encoder] + ["-y", output_path]
+        try:
+            subprocess.run(cmd, check=True, capture_output=True)
+        except subprocess.CalledProcessError as e:
+            if encoder == "libx264" or not any(marker in e.stderr for marker in ENCODER_OPEN_ERRORS):
+                raise
+            logger.warning(f"{encoder} could not be opened, retrying with libx264")
+            cmd = cmd_prefix + encode_args + H264_ENCODERS["libx264"] + ["-y", output_path]
             subprocess.run(cmd, check=True, capture_output=True)
-            logger.info(f"Audio extracted to {output_audio_path}")
-            return output_audio_path
-        except Exception as e:
-            logger.error(f"Error extracting audio: {str(e)}")
-            raise
     
     def resize_video(self, video_path: str, output_path: str) -> str:
-        """Resize video to target resolution (16:9 vertical format)"""
+        """Resize video to target resolution (9:16 vertical format)"""
         try:
             logger.info(f"Resizing video to {self.target_resolution}")
-            video = VideoFileClip(video_path)
+            target_w, target_h = self.target_resolution
             
-            input_w, input_h = video.size
-            target_h, target_w = self.target_resolution
-            
-            scale_w = target_w / input_w
-            scale_h = target_h / input_h
-            scale = max(scale_w, scale_h)
-            
-            new_w = int(input_w * scale)
-            new_h = int(input_h * scale)
-            
-            resized = video.resize((new_w, new_h))
-            x_center = (new_w - target_w) // 2
-            y_center = (new_h - target_h) // 2
-            
-            cropped = resized.crop(
-                x1=x_center,
-                y1=y_center,
-                x2=x_center + target_w,
-                y2=y_center + target_h
+            # Scale to cover the target frame, then center-crop
+            vf = (
+                f"scale={target_w}:{target_h}:force_original_aspect_ratio=increase,"
+                f"crop={target_w}:{target_h}"
             )
-            
-            cropped.write_videofile(output_path, verbose=False, logger=None)
-            video.close()
+            cmd = [
+                "ffmpeg", "-i", video_path,
+                "-vf", vf,
+                "-c:a", "aac"
+            ]
+            self._run_encode(cmd, output_path)
             logger.info(f"Video resized and saved to {output_path}")
             return output_path
         
@@ -61,31 +95,26 @@ class VideoProcessor:
             logger.error(f"Error resizing video: {str(e)}")
             raise
     
-    def add_subtitles(self, video_path: str, srt_path: str, output_path: str) -> str:
-        """Add subtitles to video using ffmpeg"""
+    def add_subtitles(self, video_path: str, subtitle_path: str, output_path: str) -> str:
+        """Add subtitles (.ass with embedded styling, or .srt) to video using ffmpeg"""
         try:
             logger.info(f"Adding subtitles to video")
             
-            import shutil
-            video_dir = os.path.dirname(video_path)
-            subtitle_filename = "subtitles.srt"
-            srt_copy_path = os.path.join(video_dir, subtitle_filename)
-            
-            # Only copy if source and destination are different
-            if os.path.abspath(srt_path) != os.path.abspath(srt_copy_path):
-                shutil.copy(srt_path, srt_copy_path)
+            subtitle_ffmpeg_path = escape_filter_path(os.path.abspath(subtitle_path))
             
-            # Fix Windows path for FFmpeg (use forward slashes and escape colons)
-            srt_ffmpeg_path = srt_copy_path.replace("\\", "/").replace(":", "\\:")
+            # ASS is already styled, so libass renders it without SRT conversion
+            if subtitle_path.endswith(".ass"):
+                vf = f"ass={subtitle_ffmpeg_path}"
+            else:
+                vf = f"subtitles={subtitle_ffmpeg_path}:force_style='FontSize=40,PrimaryColour=&H00FFFFFF&,OutlineColour=&H000000FF&'"
             
+            # Audio is already AAC from resize_video, so copy it through
             cmd = [
                 "ffmpeg", "-i", video_path,
-                "-vf", f"subtitles='{srt_ffmpeg_path}':force_style='FontSize=40,PrimaryColour=&H00FFFFFF&,OutlineColour=&H000000FF&'",
-                "-c:a", "aac",
-                "-y", output_path
+                "-vf", vf,
+                "-c:a", "copy"
             ]
-            
-            subprocess.run(cmd, check=True, capture_output=True)
+            self._run_encode(cmd, output_path)
             logger.info(f"Subtitles added and video saved to {output_path}")
             return output_path
         
@@ -93,28 +122,116 @@ class VideoProcessor:
             logger.error(f"Error adding subtitles: {str(e)}")
             raise
     
-    def create_highlight_video(self, video_path: str, highlights: list, output_path: str) -> str:
-        """Create a video with only highlight segments"""
+    @staticmethod
+    def get_duration(video_path: str) -> float:
+        """Get video duration in seconds using ffprobe"""
+        cmd = [
+            "ffprobe", "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            video_path
+        ]
+        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        return float(result.stdout.strip())
+    
+    @staticmethod
+    def has_audio(video_path: str) -> bool:
+        """Check whether the video has an audio stream using ffprobe"""
+        cmd = [
+            "ffprobe", "-v", "error",
+            "-select_streams", "a",
+            "-show_entries", "stream=index",
+            "-of", "csv=p=0",
+            video_path
+        ]
+        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        return bool(result.stdout.strip())
+    
+    def create_highlight_video(self, video_path: str, highlights: list, output_path: str):
+        """Create a video with only highlight segments; returns None if none were long enough to cut"""
         try:
             logger.info(f"Creating highlight video from {len(highlights)} segments")
-            video = VideoFileClip(video_path)
+            duration = self.get_duration(video_path)
             
-            clips = []
+            segments = []
             for highlight in highlights:
                 start = max(0, highlight['start'])
-                end = min(video.duration, highlight['end'])
+                end = min(duration, highlight['end'])
                 if end - start > 0.5:
-                    clip = video.subclip(start, end)
-                    clips.append(clip)
+                    segments.append((start, end))
             
-            if clips:
-                final_clip = concatenate_videoclips(clips)
-                final_clip.write_videofile(output_path, verbose=False, logger=None)
-                logger.info(f"Highlight video saved to {output_path}")
+            if not segments:
+                logger.info("No highlight segments to cut, skipping highlight video")
+                return None
             
-            video.close()
+            if self.precise_cuts:
+                self._concat_reencode(video_path, segments, output_path)
+            else:
+                self._concat_stream_copy(video_path, segments, output_path)
+            logger.info(f"Highlight video saved to {output_path}")
             return output_path
         
         except Exception as e:
             logger.error(f"Error creating highlight video: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+    
+    @staticmethod
+    def _cut_segment(video_path: str, start: float, end: float, output_path: str):
+        """Stream-copy a single [start, end) segment (keyframe aligned)"""
+        cmd = [
+            "ffmpeg", "-ss", f"{start:.3f}", "-i", video_path,
+            "-t", f"{end - start:.3f}",
+            "-c", "copy",
+            "-avoid_negative_ts", "make_zero",
+            "-y", output_path
+        ]
+        subprocess.run(cmd, check=True, capture_output=True)
+    
+    def _concat_stream_copy(self, video_path: str, segments: list, output_path: str):
+        """Join segments by stream copy (fast, cuts snap to keyframes)"""
+        temp_dir = tempfile.mkdtemp(dir=os.path.dirname(output_path) or None)
+        try:
+            segment_paths = [
+                os.path.join(temp_dir, f"seg_{i}.mp4") for i in range(len(segments))
+            ]
+            
+            # Cut each segment without re-encoding; ffmpeg does the work
+            with ThreadPoolExecutor(max_workers=min(4, len(segments))) as executor:
+                futures = [
+                    executor.submit(self._cut_segment, video_path, start, end, path)
+                    for (start, end), path in zip(segments, segment_paths)
+                ]
+                for future in futures:
+                    future.result()
+            
+            list_path = os.path.join(temp_dir, "list.txt")
+            with open(list_path, "w") as f:
+                for path in segment_paths:
+                    f.write(f"file '{os.path.abspath(path)}'\n")
+            
+            cmd = [
+                "ffmpeg", "-f", "concat", "-safe", "0",
+                "-i", list_path,
+                "-c", "copy",
+                "-y", output_path
+            ]
+            subprocess.run(cmd, check=True, capture_output=True)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    
+    def _concat_reencode(self, video_path: str, segments: list, output_path: str):
+        """Cut and join segments frame-accurately in a single ffmpeg process"""
+        # One seeked input per segment, so only the needed ranges are decoded
+        cmd = ["ffmpeg"]
+        for start, end in segments:
+            cmd += ["-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", video_path]
+        
+        n = len(segments)
+        if self.has_audio(video_path):
+            filter_complex = "".join(f"[{i}:v][{i}:a]" for i in range(n)) + f"concat=n={n}:v=1:a=1[v][a]"
+            cmd += ["-filter_complex", filter_complex, "-map", "[v]", "-map", "[a]", "-c:a", "aac"]
+        else:
+            # Silent source: video-only graph
+            filter_complex = "".join(f"[{i}:v]" for i in range(n)) + f"concat=n={n}:v=1:a=0[v]"
+            cmd += ["-filter_complex", filter_complex, "-map", "[v]"]
+        self._run_encode(cmd, output_path)